@@ -1,21 +1,19 @@
 import os
-import configparser
 import urllib
 
 
 from flask import Flask, redirect, url_for
 
 from . import auth, feed, about
+from feed_amalgamator.helpers.config_helper import ConfigHelper
 from feed_amalgamator.helpers.db_interface import dbi
 from feed_amalgamator.helpers import error_handler # noqa
-from feed_amalgamator.constants.common_constants import CONFIG_LOC
+from feed_amalgamator.constants.common_constants import CONFIG_LOC, TIMELINE_REFRESH_INTERVAL
 
 
 def create_app(test_config=None, db_file_name=None):
-    parser = configparser.ConfigParser()
     # Setting up the loggers and interface layers
-    with open(CONFIG_LOC) as file:
-        parser.read_file(file)
+    parser = ConfigHelper.load_config(CONFIG_LOC)
     # create and configure the app
     environment_type = parser["ENVIRONMENT"]["ENVIRONMENT"]
     secret_key = parser["ENVIRONMENT"]["SECRET_KEY"]
@@ -53,6 +51,12 @@ def create_app(test_config=None, db_file_name=None):
     app.config["SQLALCHEMY_DATABASE_URI"] = db_location
     dbi.init_app(app)
 
+    # Keeps the timelines of active users warm so the home page is usually served from memory.
+    # Tests turn it off through test_config so no thread is left polling Mastodon in the background
+    if app.config.get("TIMELINE_BACKGROUND_REFRESH",
+                      parser.getboolean("CACHE_SETTINGS", "timeline_background_refresh", fallback=True)):
+        feed.data_api.start_background_refresh(TIMELINE_REFRESH_INTERVAL)
+
     @app.route("/", methods=["GET"])
     def redirect_internal():
         return redirect(url_for("feed.feed_home"))
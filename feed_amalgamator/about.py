@@ -1,5 +1,4 @@
 import logging
-import configparser
 from pathlib import Path
 
 from flask import (
@@ -8,6 +7,7 @@ from flask import (
 )
 
 from feed_amalgamator.constants.common_constants import CONFIG_LOC
+from feed_amalgamator.helpers.config_helper import ConfigHelper
 from feed_amalgamator.helpers.logging_helper import LoggingHelper
 
 bp = Blueprint("about", __name__)
@@ -15,9 +15,7 @@ bp = Blueprint("about", __name__)
 # Setup for logging and interface layers
 
 # Setting up the loggers and interface layers
-parser = configparser.ConfigParser()
-with open(CONFIG_LOC) as file:
-    parser.read_file(file)
+parser = ConfigHelper.load_config(CONFIG_LOC)
 log_file_loc = Path(parser["LOG_SETTINGS"]["auth_log_loc"])
 logger = LoggingHelper.generate_logger(logging.INFO, log_file_loc, "auth_page")
 
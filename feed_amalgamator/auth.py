@@ -2,7 +2,6 @@
 
 import functools
 import logging
-import configparser
 from pathlib import Path
 
 import sqlalchemy.exc
@@ -20,6 +19,7 @@ from feed_amalgamator.helpers.custom_exceptions import InvalidCredentialsError,
 
 from feed_amalgamator.helpers.db_interface import dbi, User
 
+from feed_amalgamator.helpers.config_helper import ConfigHelper
 from feed_amalgamator.helpers.logging_helper import LoggingHelper
 
 from werkzeug.security import check_password_hash, generate_password_hash
@@ -35,9 +35,7 @@ bp = Blueprint("auth", __name__, url_prefix="/auth")
 # Setup for logging and interface layers
 
 # Setting up the loggers and interface layers
-parser = configparser.ConfigParser()
-with open(CONFIG_LOC) as file:
-    parser.read_file(file)
+parser = ConfigHelper.load_config(CONFIG_LOC)
 log_file_loc = Path(parser["LOG_SETTINGS"]["auth_log_loc"])
 logger = LoggingHelper.generate_logger(logging.INFO, log_file_loc, "auth_page")
 
@@ -2,6 +2,13 @@
 
 CONFIG_LOC = "configuration/app_settings.ini"
 NUM_POSTS_TO_GET = 20
+REQUIRED_SCOPES = ("read", "write", "push")  # Hard coded scopes the app needs. Revisit if the scope changes
+CLIENT_CACHE_SIZE = 64  # Max number of user Mastodon API clients kept alive for reuse
+DOMAIN_CACHE_TTL = 600  # Seconds a verified mastodon domain is remembered before being checked again
+TOKEN_CACHE_TTL = 300  # Seconds a generated user access token is remembered for a repeated auth code
+TIMELINE_REFRESH_INTERVAL = 45  # Seconds between background refreshes of recently requested timelines
+TIMELINE_STALENESS_BUDGET = 60  # Seconds a fetched timeline may be served from memory
+TIMELINE_IDLE_TIMEOUT = 600  # Seconds without a request before a timeline stops being refreshed
 
 SORT_BY = "favourites_count"
 FILTER_LIST = ["uri", "in_reply_to_id", "in_reply_to_account_id", "muted", "language"]
@@ -1,16 +1,17 @@
 """Code for handling the main, feed page via flask"""
 
-import configparser
+import asyncio
 import logging
 from pathlib import Path
 
 from flask import Blueprint, flash, redirect, render_template, request, session, url_for
 
 from feed_amalgamator.constants.common_constants import CONFIG_LOC, FILTER_LIST, USER_ID_FIELD, HOME_TIMELINE_NAME, \
-    NUM_POSTS_TO_GET, USER_DOMAIN_FIELD, SORT_BY, SERVERS_FIELD, ORIGINAL_SERVER_FIELD
+    NUM_POSTS_TO_GET, USER_DOMAIN_FIELD, SORT_BY, SERVERS_FIELD, ORIGINAL_SERVER_FIELD, DOMAIN_CACHE_TTL
 from feed_amalgamator.helpers.custom_exceptions import (
     MastodonConnError, NoContentFoundError, InvalidDomainError, IntegrityError, InvalidApiInputError, AddServerInvalidCredentialsError, AddServerIntegrityError,
     AddServerServiceUnavailableError)
+from feed_amalgamator.helpers.config_helper import ConfigHelper
 from feed_amalgamator.helpers.logging_helper import LoggingHelper
 from feed_amalgamator.helpers.mastodon_data_interface import MastodonDataInterface
 from feed_amalgamator.helpers.mastodon_oauth_interface import MastodonOAuthInterface
@@ -20,14 +21,14 @@ from feed_amalgamator.constants.error_messages import NO_CONTENT_FOUND_MSG, USER
     INVALID_DELETE_SERVER_RECORD_MSG, AUTH_CODE_ERROR_MSG, REDIRECT_HOME, REDIRECT_ADD_SERVER
 
 bp = Blueprint("feed", __name__, url_prefix="/feed")
-parser = configparser.ConfigParser()
 # Setting up the loggers and interface layers
-with open(CONFIG_LOC) as file:
-    parser.read_file(file)
+parser = ConfigHelper.load_config(CONFIG_LOC)
 log_file_loc = Path(parser["LOG_SETTINGS"]["feed_log_loc"])
 redirect_uri = parser["REDIRECT_URI"]["REDIRECT_URI"]
+# Optional setting, older config files without a CACHE_SETTINGS section fall back to the default
+domain_cache_ttl = parser.getfloat("CACHE_SETTINGS", "domain_cache_ttl", fallback=DOMAIN_CACHE_TTL)
 logger = LoggingHelper.generate_logger(logging.INFO, log_file_loc, "feed_page")
-auth_api = MastodonOAuthInterface(logger, redirect_uri)
+auth_api = MastodonOAuthInterface(logger, redirect_uri, domain_cache_ttl)
 data_api = MastodonDataInterface(logger)
 AUTH_LOGIN = "auth.login"
 
@@ -60,17 +61,16 @@ def feed_home():
                                        "message": NO_CONTENT_FOUND_MSG})
         else:
             logger.info("Found {n} servers tied to user id {i}".format(n=len(user_servers), i=provided_user_id))
+            # These are user_server objects defined in the data interface. Treat them like python objects
+            # All servers are queried concurrently, so the wait is that of the slowest server rather than the sum
+            wanted_timelines = [(user_server.server, user_server.token, HOME_TIMELINE_NAME, NUM_POSTS_TO_GET)
+                                for user_server in user_servers]
+            fetched_timelines = asyncio.run(data_api.fetch_many(wanted_timelines))
             timelines = []
-            for user_server in user_servers:
-                # These are user_server objects defined in the data interface. Treat them like python objects
-                server_domain = user_server.server
-                access_token = user_server.token
-                data_api.start_user_api_client(user_domain=server_domain, user_access_token=access_token)
-
-                timeline = data_api.get_timeline_data(HOME_TIMELINE_NAME, NUM_POSTS_TO_GET)
+            for user_server, timeline in zip(user_servers, fetched_timelines):
                 # Add server it was retrieved from to be accessed by frontend
                 for post in timeline:
-                    post[ORIGINAL_SERVER_FIELD] = server_domain
+                    post[ORIGINAL_SERVER_FIELD] = user_server.server
                 timelines.extend(timeline)
             timelines = filter_sort_feed(timelines)
             return render_template(REDIRECT_HOME, timelines=timelines)
@@ -96,7 +96,6 @@ def render_redirect_url_page():
 
     domain = request.form[USER_DOMAIN_FIELD]
     logger.info("Rendering redirect url for user inputted domain {d}".format(d=domain))
-    session[USER_DOMAIN_FIELD] = domain
 
     is_valid_domain, parsed_domain = auth_api.verify_user_provided_domain(domain)
 
@@ -105,6 +104,8 @@ def render_redirect_url_page():
         raise InvalidDomainError({
             "redirect_path": REDIRECT_ADD_SERVER,
             "message": error_message})
+    # Store the canonical domain rather than the raw input, as it is what the user's server is saved under
+    session[USER_DOMAIN_FIELD] = parsed_domain
     app_token_obj = auth_api.check_if_domain_exists_in_database(parsed_domain)
     if app_token_obj is not None:
         logger.info("App token for domain found in database")
@@ -0,0 +1,85 @@
+"""Bounded, thread safe cache for Mastodon API clients, and the http sessions they share.
+
+Reusing clients across requests, and sharing one http session between all clients talking to the same server,
+lets repeated calls to an instance ride on already established keep-alive connections"""
+
+import threading
+from collections import OrderedDict
+from collections.abc import Hashable
+
+import requests
+from mastodon import Mastodon
+from requests.adapters import HTTPAdapter
+
+SESSION_POOL_MAXSIZE = 100  # Max keep-alive connections held open to a single server
+
+"""Server -> http session shared by every Mastodon client talking to that server"""
+_SESSION_BY_HOST: dict[str, requests.Session] = {}
+_session_lock = threading.Lock()
+
+
+def _make_session() -> requests.Session:
+    session = requests.Session()
+    session.mount("https://", HTTPAdapter(pool_maxsize=SESSION_POOL_MAXSIZE))
+    return session
+
+
+def get_shared_session(host: str) -> requests.Session:
+    """
+    Returns the http session shared by all clients of a server, creating it on first use. Passing it to
+    Mastodon(session=...) means a spike of users on one server reuses a bounded set of TLS connections
+    instead of each client opening its own
+
+    :param host: Server the session is for, eg. mastodon.social
+    :return: The shared session
+    """
+    with _session_lock:
+        session = _SESSION_BY_HOST.get(host)
+        if session is None:
+            session = _SESSION_BY_HOST[host] = _make_session()
+        return session
+
+
+class ClientCache:
+    """Least recently used cache of Mastodon clients. Once maxsize clients are held, the client that
+    has gone unused for the longest is evicted to keep memory bounded"""
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._clients: OrderedDict[Hashable, Mastodon] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Mastodon | None:
+        """
+        Returns the cached client for the key, marking it as the most recently used
+
+        :param key: Key the client was stored under
+        :return: The cached client, or None if there is no client for the key
+        """
+        with self._lock:
+            client = self._clients.get(key)
+            if client is not None:
+                self._clients.move_to_end(key)
+            return client
+
+    def put(self, key: Hashable, client: Mastodon):
+        """
+        Stores a client, evicting the least recently used client if the cache is full
+
+        :param key: Key to store the client under
+        :param client: The client to store
+        """
+        with self._lock:
+            self._clients[key] = client
+            self._clients.move_to_end(key)
+            while len(self._clients) > self.maxsize:
+                self._clients.popitem(last=False)
+
+    def pop(self, key: Hashable):
+        """
+        Removes the client for the key if present, eg. when its credentials turn out to be invalid
+
+        :param key: Key the client was stored under
+        """
+        with self._lock:
+            self._clients.pop(key, None)
@@ -0,0 +1,21 @@
+import configparser
+import functools
+
+
+class ConfigHelper:
+    """Centralized class for reading the app's configuration files. Files are parsed once per process
+    and shared, rather than re-read from disk by every module and every app instance that needs them"""
+
+    @staticmethod
+    @functools.lru_cache(maxsize=8)
+    def load_config(config_file_loc: str) -> configparser.ConfigParser:
+        """
+        Reads and parses a configuration file, caching the result for subsequent calls
+
+        :param config_file_loc: Location of the ini file to read. Pass it as a str so it can be used as a cache key
+        :return: The parsed configuration. Shared between callers, so treat it as read only
+        """
+        parser = configparser.ConfigParser()
+        with open(config_file_loc) as file:
+            parser.read_file(file)
+        return parser
@@ -2,7 +2,6 @@
 raised exceptions"""
 
 import logging
-import configparser
 from flask import render_template, redirect, url_for, flash
 from pathlib import Path
 
@@ -13,12 +12,11 @@ from feed_amalgamator.helpers.custom_exceptions import (
     AddServerInvalidCredentialsError)
 from feed_amalgamator.auth import bp as auth_bp
 from feed_amalgamator.feed import bp as feed_bp
+from feed_amalgamator.helpers.config_helper import ConfigHelper
 from feed_amalgamator.helpers.logging_helper import LoggingHelper
 
-parser = configparser.ConfigParser()
 # Setting up the loggers and interface layers
-with open(CONFIG_LOC) as file:
-    parser.read_file(file)
+parser = ConfigHelper.load_config(CONFIG_LOC)
 log_file_loc = Path(parser["LOG_SETTINGS"]["feed_log_loc"])
 redirect_uri = parser["REDIRECT_URI"]["REDIRECT_URI"]
 feed_logger = LoggingHelper.generate_logger(logging.INFO, log_file_loc, "feed_page")
@@ -2,16 +2,35 @@
 
 Any module interacting with the Mastodon API post-oauth (for data collection) should do so strictly through this layer"""
 
+import asyncio
+import hashlib
 import logging
+import operator
+import threading
+from datetime import datetime
+from http import HTTPStatus
 
+import aiohttp
 import mastodon.errors
-from mastodon import MastodonAPIError, Mastodon
+from mastodon import MastodonAPIError, MastodonNetworkError, Mastodon
 
+from feed_amalgamator.constants.common_constants import CLIENT_CACHE_SIZE, TIMELINE_STALENESS_BUDGET, \
+    TIMELINE_IDLE_TIMEOUT, REQUIRED_SCOPES
+from feed_amalgamator.helpers.client_cache import ClientCache, get_shared_session
 from feed_amalgamator.helpers.custom_exceptions import (
     MastodonConnError,
     InvalidCredentialsError,
     ServiceUnavailableError
 )
+from feed_amalgamator.helpers.retry_helper import retry_on, async_retry_with_backoff
+from feed_amalgamator.helpers.timeline_cache import TimelineCache, TimelineRequest
+
+_UNSET_CLIENT_MSG = "User client has not been started"
+# Endpoint hit directly by the async fan out, bypassing Mastodon.py's synchronous wrapper. Takes an api base url
+_TIMELINE_URL_FMT = "%s/api/v1/timelines/%s"
+# Bounds how many simultaneous connections a single fan out opens against one server
+MAX_CONNECTIONS_PER_HOST = 64
+ASYNC_HTTP_TIMEOUT = aiohttp.ClientTimeout(sock_connect=3.05, sock_read=5)
 
 
 class MastodonDataInterface:
@@ -20,6 +39,12 @@ class MastodonDataInterface:
     libraries.
     """
 
+    """User clients shared across all instances, keyed by (domain, hash of access token), so that repeated
+    timeline polls for the same user skip client construction and the token sanity check"""
+    _user_client_cache = ClientCache(CLIENT_CACHE_SIZE)
+    """Hard coded required scopes for the app to work. Shared by all instances"""
+    REQUIRED_SCOPES = REQUIRED_SCOPES
+
     def __init__(self, logger: logging.Logger):
         """We pass in a logger instead of creating a new one
         As we want logs to be logged to the program calling the interface
@@ -27,31 +52,47 @@ class MastodonDataInterface:
         self.logger = logger
         """This is the client to perform actions on the user's behalf"""
         self.user_client = None
-        """Hard coded required scopes for the app to work"""
-        self.REQUIRED_SCOPES = ["read", "write", "push"]
+        """Key user_client is stored under in the user client cache, so it can be evicted if its token is revoked"""
+        self._user_client_key = None
+        """Recently fetched timelines, served by fetch_many while fresh and kept warm by the background refresh"""
+        self.timeline_cache = TimelineCache(TIMELINE_STALENESS_BUDGET, TIMELINE_IDLE_TIMEOUT)
+        self._refresh_thread = None
+        self._stop_refresh = threading.Event()
 
     def start_user_api_client(self, user_domain: str, user_access_token: str):
         """
         Function to start a new client using the authorization code provided by the user.
-        Does a sanity check to see if the user api access token is valid
+        Does a sanity check to see if the user api access token is valid. The feed page fetches timelines
+        through fetch_many instead, which does not need a client; this is kept for one off synchronous calls
 
         :param user_domain: User's account domain (eg. mstdn.social, tomorrow.io).
         :param user_access_token: The user access token generated from the auth procedure
         :return: None, but side effect of setting user_client
         """
+        # Hash the token so raw credentials are not held as dictionary keys
+        cache_key = (user_domain, hashlib.sha256(user_access_token.encode()).hexdigest())
+        cached_client = self._user_client_cache.get(cache_key)
+        if cached_client is not None:
+            # Token was already sanity checked when the client was first started
+            self.user_client = cached_client
+            self._user_client_key = cache_key
+            return
         try:
             self.logger.info("Starting user api client")
-            client = Mastodon(access_token=user_access_token, api_base_url=user_domain)
+            client = Mastodon(access_token=user_access_token, api_base_url=user_domain,
+                              session=get_shared_session(user_domain))
             # Getting 1 post from timeline to sanity check if the user access token was valid
             client.timeline(timeline="home", limit=1)
+            self._user_client_cache.put(cache_key, client)
             self.user_client = client
+            self._user_client_key = cache_key
             self.logger.info("Successfully started user API client")
         except mastodon.errors.MastodonUnauthorizedError:
             raise InvalidCredentialsError({
                 "redirect_page": "feed/add_server.html",
                 "message": "Invalid access token"
             })
-        except (ConnectionError, MastodonAPIError) as err:
+        except (ConnectionError, MastodonNetworkError, MastodonAPIError) as err:
             conn_error_msg = "Encountered error {e} in start_user_api_client".format(e=err)
             self.logger.error(conn_error_msg)
             raise MastodonConnError(conn_error_msg)
@@ -59,26 +100,41 @@ class MastodonDataInterface:
     # === Functions to get data from here on out =====
     def get_timeline_data(self, timeline_name: str, num_posts_to_get: int, num_tries=3) -> list[dict]:
         """
-        Extracts data from the wanted timeline
+        Extracts data from the wanted timeline through the client set by start_user_api_client.
+        Synchronous counterpart of get_timeline_data_async, which the feed page uses through fetch_many
 
         :param timeline_name: Name of the timeline to get data from
         :param num_posts_to_get: Number of posts to obtain from the timeline
         :param num_tries: Number of tries to get the data before giving up
         :return: List of dictionaries containing the obtained data
         """
-        assert self.user_client is not None, "User client has not been started"
-        for i in range(num_tries):
-            try:
-                self.logger.info("Starting to get timeline data")
-                timeline = self.user_client.timeline(timeline=timeline_name, limit=num_posts_to_get)
-                standardized_timeline = self._standardize_api_objects(timeline)
-                self.logger.info("Successfully obtained timeline data")
-                return standardized_timeline
-            except (ConnectionError, MastodonAPIError) as err:
-                self.logger.error("Encountered error {e} in start_user_api_client." "Retrying".format(e=err))
-        raise ServiceUnavailableError({
-            "redirect_page": "feed/home.html",
-            "message": "Failed to get timeline data after trying {n} times".format(n=num_tries)})
+        if self.user_client is None:
+            raise RuntimeError(_UNSET_CLIENT_MSG)
+        self.logger.debug("Starting to get timeline data")
+        try:
+            timeline = self._request_timeline(timeline_name, num_posts_to_get, num_tries=num_tries)
+        except mastodon.errors.MastodonUnauthorizedError:
+            # The token was revoked after the client was cached. Evict it so the next start re-checks the token
+            self._user_client_cache.pop(self._user_client_key)
+            raise InvalidCredentialsError({
+                "redirect_page": "feed/add_server.html",
+                "message": "Invalid access token"
+            })
+        except MastodonConnError:
+            raise ServiceUnavailableError({
+                "redirect_page": "feed/home.html",
+                "message": "Failed to get timeline data after trying {n} times".format(n=num_tries)})
+        except MastodonAPIError as err:
+            raise ServiceUnavailableError({
+                "redirect_page": "feed/home.html",
+                "message": "Server rejected the timeline request: {e}".format(e=err)})
+        standardized_timeline = self._standardize_api_objects(timeline)
+        self.logger.info("Successfully obtained timeline data")
+        return standardized_timeline
+
+    @retry_on(host_of=operator.attrgetter("user_client.api_base_url"))
+    def _request_timeline(self, timeline_name: str, num_posts_to_get: int) -> mastodon.utility.AttribAccessList:
+        return self.user_client.timeline(timeline=timeline_name, limit=num_posts_to_get)
 
     def _standardize_api_objects(self, raw_timeline: mastodon.utility.AttribAccessList) -> list[dict]:
         """
@@ -87,5 +143,170 @@ class MastodonDataInterface:
         :param raw_timeline: Raw timeline object generated by the third party API of type mastodon.utility
         :return: Standardized list of dictionaries of information contained in the API object
         """
-        # Simple conversion for now, but will come in very handy if there is a breaking API change
-        return [dict(item) for item in raw_timeline]
+        # Simple conversion for now, but will come in very handy if there is a breaking API change.
+        # Posts are AttribAccessDicts, which already subclass dict, so they are passed through instead of copied
+        return list(raw_timeline)
+
+    # === Async functions to fetch several timelines concurrently =====
+    async def fetch_many(self, timelines: list[TimelineRequest], num_tries=3) -> list[list[dict]]:
+        """
+        Fetches several timelines concurrently, so the total wait is roughly that of the slowest server
+        instead of the sum of all of them. Timelines fetched within the staleness budget are served from
+        the timeline cache instead
+
+        :param timelines: List of (user domain, user access token, timeline name, number of posts to get)
+        :param num_tries: Number of tries to get each timeline before giving up
+        :return: One standardized timeline per requested timeline, in the same order as requested
+        """
+        results = [self.timeline_cache.get(timeline) for timeline in timelines]
+        missing = [i for i, result in enumerate(results) if result is None]
+        if missing:
+            fetched = await self._fetch_all([timelines[i] for i in missing], num_tries)
+            for i, posts in zip(missing, fetched):
+                self.timeline_cache.put(timelines[i], posts)
+                results[i] = posts
+        return results
+
+    async def _fetch_all(self, timelines: list[TimelineRequest], num_tries: int,
+                         return_exceptions=False) -> list[list[dict] | BaseException]:
+        """
+        Fetches timelines concurrently, bypassing the cache. All requests share one connection pool for the
+        duration of the call
+
+        :param return_exceptions: Return errors in place of the failed timelines instead of raising the first one
+        """
+        connector = aiohttp.TCPConnector(limit_per_host=MAX_CONNECTIONS_PER_HOST)
+        async with aiohttp.ClientSession(connector=connector, timeout=ASYNC_HTTP_TIMEOUT) as http_session:
+            return list(await asyncio.gather(*[
+                self._fetch_one(http_session, user_domain, user_access_token, timeline_name, num_posts_to_get,
+                                num_tries)
+                for user_domain, user_access_token, timeline_name, num_posts_to_get in timelines
+            ], return_exceptions=return_exceptions))
+
+    def start_background_refresh(self, interval: float):
+        """
+        Starts a daemon thread that re-fetches recently requested timelines every interval seconds, so that
+        repeat polls are served from the cache instead of waiting on the Mastodon API. Does nothing if the
+        refresh is already running
+
+        :param interval: Seconds between two refreshes. Should be below the staleness budget
+        """
+        if self._refresh_thread is not None and self._refresh_thread.is_alive():
+            return
+        self._stop_refresh.clear()
+        self._refresh_thread = threading.Thread(target=self._refresh_loop, args=(interval,), daemon=True,
+                                                name="timeline-refresh")
+        self._refresh_thread.start()
+
+    def stop_background_refresh(self):
+        """Signals the background refresh to stop after its current iteration"""
+        self._stop_refresh.set()
+
+    def _refresh_loop(self, interval: float):
+        while not self._stop_refresh.wait(interval):
+            timelines = self.timeline_cache.active_requests()
+            if not timelines:
+                continue
+            try:
+                # Single try per refresh, the next refresh acts as the retry
+                fetched = asyncio.run(self._fetch_all(timelines, num_tries=1, return_exceptions=True))
+            except Exception as err:  # Never let an unexpected error kill the refresh thread
+                self.logger.error("Encountered %s while refreshing timelines", err)
+                continue
+            for timeline, posts in zip(timelines, fetched):
+                if isinstance(posts, InvalidCredentialsError):
+                    # The token was revoked. Polling with it again would only keep failing until the idle timeout
+                    self.logger.warning("Stopped refreshing timeline from %s: access token rejected", timeline[0])
+                    self.timeline_cache.forget(timeline)
+                elif isinstance(posts, BaseException):
+                    self.logger.warning("Failed to refresh timeline from %s: %s", timeline[0], posts)
+                else:
+                    self.timeline_cache.put(timeline, posts)
+
+    async def get_timeline_data_async(self, user_domain: str, user_access_token: str, timeline_name: str,
+                                      num_posts_to_get: int, num_tries=3) -> list[dict]:
+        """
+        Async counterpart of get_timeline_data. Does not need start_user_api_client to be called first
+
+        :param user_domain: User's account domain (eg. mstdn.social, tomorrow.io).
+        :param user_access_token: The user access token generated from the auth procedure
+        :param timeline_name: Name of the timeline to get data from
+        :param num_posts_to_get: Number of posts to obtain from the timeline
+        :param num_tries: Number of tries to get the data before giving up
+        :return: List of dictionaries containing the obtained data
+        """
+        (timeline,) = await self.fetch_many([(user_domain, user_access_token, timeline_name, num_posts_to_get)],
+                                            num_tries)
+        return timeline
+
+    async def _fetch_one(self, http_session: aiohttp.ClientSession, user_domain: str, user_access_token: str,
+                         timeline_name: str, num_posts_to_get: int, num_tries: int) -> list[dict]:
+        """
+        Fetches a single timeline through the Mastodon REST API, retrying with backoff on connection errors,
+        rate limiting and server errors. Other error statuses fail straight away
+
+        :param http_session: Session shared by all timelines of the current fan out
+        :return: Standardized list of dictionaries containing the obtained data
+        """
+        api_base_url = self._to_api_base_url(user_domain)
+        url = _TIMELINE_URL_FMT % (api_base_url, timeline_name)
+        headers = {"Authorization": "Bearer {t}".format(t=user_access_token), "Accept": "application/json"}
+        params = {"limit": num_posts_to_get}
+
+        async def request_timeline() -> list[dict]:
+            async with http_session.get(url, headers=headers, params=params) as response:
+                if response.status == HTTPStatus.UNAUTHORIZED:
+                    raise InvalidCredentialsError({
+                        "redirect_path": "feed/add_server.html",
+                        "message": "Invalid access token"
+                    })
+                if HTTPStatus.BAD_REQUEST <= response.status < HTTPStatus.INTERNAL_SERVER_ERROR and \
+                        response.status != HTTPStatus.TOO_MANY_REQUESTS:
+                    # Any other client error is about this request, not a struggling server. Fail without retrying
+                    raise ServiceUnavailableError({
+                        "redirect_path": "feed/home.html",
+                        "message": "Server rejected the timeline request with status {s}".format(s=response.status)
+                    })
+                response.raise_for_status()
+                return await response.json()
+
+        self.logger.debug("Starting to get timeline data from %s", user_domain)
+        try:
+            # Keyed by the same api base url as Mastodon.py's clients, so both paths share one circuit per server
+            raw_timeline = await async_retry_with_backoff(request_timeline, num_tries,
+                                                          (aiohttp.ClientError, asyncio.TimeoutError),
+                                                          self.logger, "fetch timeline from {d}".format(d=user_domain),
+                                                          host=api_base_url)
+        except MastodonConnError as err:
+            raise ServiceUnavailableError({
+                "redirect_path": "feed/home.html",
+                "message": "Failed to get timeline data: {e}".format(e=err)})
+        self.logger.info("Successfully obtained timeline data from %s", user_domain)
+        return self._standardize_json_posts(raw_timeline)
+
+    @staticmethod
+    def _to_api_base_url(user_domain: str) -> str:
+        """
+        Normalizes a stored server the way Mastodon.py does for its clients. Servers added before domains were
+        cleaned on input may include a scheme or a trailing slash, eg. https://mastodon.social/
+
+        :param user_domain: Server as stored for the user
+        :return: The server's api base url, eg. https://mastodon.social
+        """
+        if not user_domain.startswith(("http://", "https://")):
+            user_domain = "https://" + user_domain
+        return user_domain.rstrip("/")
+
+    def _standardize_json_posts(self, raw_timeline: list[dict]) -> list[dict]:
+        """
+        Brings posts fetched straight from the REST API in line with those returned by Mastodon.py,
+        which converts timestamps into datetime objects
+
+        :param raw_timeline: Posts as decoded from the API's json response
+        :return: The same posts, with created_at parsed into a datetime
+        """
+        for post in raw_timeline:
+            for status in (post, post.get("reblog")):
+                if status is not None and isinstance(status.get("created_at"), str):
+                    status["created_at"] = datetime.fromisoformat(status["created_at"])
+        return raw_timeline
@@ -2,25 +2,48 @@
 
 Any module interacting with the Mastodon API for Oauth purposes should do so strictly through this layer"""
 
+import hashlib
+import ipaddress
 import logging
 import json
+import operator
+import re
+import socket
+import threading
+import time
 import mastodon.errors
+import orjson
 import requests
-from urllib.parse import urlparse
+from requests.adapters import HTTPAdapter
+from urllib.parse import urljoin, urlsplit
 from http import HTTPStatus
 
 import sqlalchemy.exc
 from mastodon import Mastodon, MastodonAPIError  # pip install Mastodon.py
 
+from feed_amalgamator.constants.common_constants import DOMAIN_CACHE_TTL, TOKEN_CACHE_TTL, REQUIRED_SCOPES
 from feed_amalgamator.constants.error_messages import INVALID_MASTODON_DOMAIN_MSG, INVALID_JSON_RESPONSE_MSG, \
     SERVICE_UNAVAILABLE_MSG, REDIRECT_ADD_SERVER
+from feed_amalgamator.helpers.client_cache import get_shared_session
 from feed_amalgamator.helpers.custom_exceptions import (
     MastodonConnError,
     InvalidApiInputError,
     ServiceUnavailableError,
 )
+from feed_amalgamator.helpers.retry_helper import retry_on
 from feed_amalgamator.helpers.db_interface import dbi, ApplicationTokens
 
+# (connect, read) timeouts in seconds for plain https calls made outside of the Mastodon.py client
+HTTP_TIMEOUT = (3.05, 5)
+# Hardcoded endpoint for generally getting an instance's info. %-formatting skips format spec parsing on every call
+_INSTANCE_URL_FMT = "https://%s/api/v2/instance"
+_UNSET_CLIENT_MSG = "App client has not been initialized"
+# Dot separated hostname labels of up to 63 characters, 253 characters in total. Cheaply weeds out malformed input
+# before it costs a DNS lookup, TLS handshake and possibly a timeout
+_DOMAIN_RE = re.compile(r"^(?=.{1,253}$)(?!-)[A-Za-z0-9-]{1,63}(?:\.[A-Za-z0-9-]{1,63})+$")
+# Redirects followed when reading an instance's info, eg. from www.mstdn.social to mstdn.social
+_MAX_REDIRECTS = 3
+
 
 class MastodonOAuthInterface:
     """Adapter Class for responsible for handling the user Oauth chain
@@ -29,17 +52,33 @@ class MastodonOAuthInterface:
     API calls for data processing AFTER Oauth is under the responsibility of MastodonDataInterface
     """
 
-    def __init__(self, logger: logging.Logger, redirect_uri: str):
+    """Hard coded required scopes for the app to work. Shared by all instances"""
+    REQUIRED_SCOPES = REQUIRED_SCOPES
+
+    def __init__(self, logger: logging.Logger, redirect_uri: str, domain_cache_ttl: float = DOMAIN_CACHE_TTL):
         """We pass in a logger instead of creating a new one
         As we want logs to be logged to the program calling the interface
         rather than have separate logs for the interface layer specifically"""
         self.logger = logger
         """This is the client used to authenticate users. Generated using our app's down details"""
         self.app_client = None
-        """Hard coded required scopes for the app to work. Revisit if the scope changes"""
-        self.REQUIRED_SCOPES = ["read", "write", "push"]
         """The redirect URI required by the API to generate certain urls"""
         self.REDIRECT_URI = redirect_uri
+        """Shared http session so repeated calls to the same instance reuse pooled keep-alive connections
+        instead of paying for DNS resolution and a TLS handshake every time"""
+        self._http = requests.Session()
+        self._http.mount("https://", HTTPAdapter(pool_connections=16, pool_maxsize=32))
+        """Cleaned domain -> (time verified, canonical domain) for domains recently verified as mastodon servers.
+        Entries older than domain_cache_ttl seconds are evicted lazily when they are next read"""
+        self._domain_cache: dict[str, tuple[float, str]] = {}
+        self.domain_cache_ttl = domain_cache_ttl
+        """(api base url, hash of auth code) -> (time generated, user access token). Lets a retried oauth callback
+        (eg. a browser refresh) reuse the token instead of exchanging the same auth code again"""
+        self._token_cache: dict[tuple[str, bytes], tuple[float, str]] = {}
+
+    def close(self):
+        """Releases the pooled connections held by the interface's http session"""
+        self._http.close()
 
     def _generate_headers_for_api_call(self):
         """Generates standardized headers to be fed into a HTTP request. A lack of these headers
@@ -59,28 +98,127 @@ class MastodonOAuthInterface:
         :return: True (if server is a legitimate mastodon domain), False otherwise
         """
         wanted_domain = self._clean_user_provided_domain(user_domain)
-
-        # Hardcoded endpoint for generally getting an instance's info
-        endpoint_to_test = "https://{d}/api/v2/instance".format(d=wanted_domain)
+        # A cache hit sends no request, so it does not need the DNS lookup done by _is_public_hostname
+        cached_domain = self._get_cached_domain(wanted_domain)
+        if cached_domain is not None:
+            return True, cached_domain
+        if not self._is_public_hostname(wanted_domain):
+            return False, "{msg_base}:{d}".format(msg_base=INVALID_MASTODON_DOMAIN_MSG, d=wanted_domain)
+
+        endpoint_to_test = _INSTANCE_URL_FMT % wanted_domain
         # As this is before any api client is created, we will use a simple https request
         error_message = None
         try:
             headers = self._generate_headers_for_api_call()
-            response = requests.get(endpoint_to_test, headers=headers)
-            if response.status_code == HTTPStatus.OK:
-                wanted_domain = json.loads(response.content)["domain"]
-                return True, wanted_domain  # Obtain the cleansed content
-        except requests.exceptions.ConnectionError:
+            if self._is_probably_canonical(wanted_domain):
+                # Fast path: only the response headers are needed to confirm the instance exists
+                head_response = self._http.head(endpoint_to_test, headers=headers, timeout=HTTP_TIMEOUT,
+                                                allow_redirects=False)
+                if (head_response.status_code == HTTPStatus.OK
+                        and head_response.headers.get("Content-Type", "").startswith("application/json")):
+                    canonical_domain = wanted_domain.lower()
+                    self._domain_cache[wanted_domain] = (time.monotonic(), canonical_domain)
+                    return True, canonical_domain
+            # Either the canonical domain has to be read from the body, or the server did not answer the HEAD
+            response = self._get_following_public_redirects(endpoint_to_test, headers)
+            if response is None:
+                error_message = "{msg_base}:{d}".format(msg_base=INVALID_MASTODON_DOMAIN_MSG, d=wanted_domain)
+            elif response.status_code == HTTPStatus.OK:
+                # orjson parses the raw bytes directly, skipping the decode of the multi KB body into a str first
+                canonical_domain = orjson.loads(response.content)["domain"]  # Obtain the cleansed content
+                # The body is controlled by the server, so the domain it names gets the same check as user input
+                if not isinstance(canonical_domain, str) or not self._is_public_hostname(canonical_domain):
+                    self.logger.warning("%s named a non public canonical domain: %s", wanted_domain, canonical_domain)
+                    return False, "{msg_base}:{d}".format(msg_base=INVALID_MASTODON_DOMAIN_MSG, d=wanted_domain)
+                self._domain_cache[wanted_domain] = (time.monotonic(), canonical_domain)
+                return True, canonical_domain
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
             # If the user domain is invalid, it is indistinguishable from a connection error (cannot resolve
-            # the domain of the redirected url)
+            # the domain of the redirected url). A server that never answers is treated the same way
             error_message = "{msg_base}:{d}".format(msg_base=INVALID_MASTODON_DOMAIN_MSG,
                                                     d=wanted_domain)
-        except json.JSONDecodeError:
+        except orjson.JSONDecodeError:
             error_message = "{msg_base}:{d}".format(msg_base=INVALID_JSON_RESPONSE_MSG,
                                                     d=wanted_domain)
 
         return False, error_message  # Failed. Could be due to connection errors or wrong domain provided
 
+    def _is_probably_canonical(self, wanted_domain: str) -> bool:
+        """
+        Guesses whether the domain is already the server's canonical domain, in which case the instance info
+        does not need to be downloaded to find it. Domains with a www. prefix usually are aliases
+        (eg. www.mstdn.social for mstdn.social), so the canonical domain is read from the instance info instead
+
+        :param wanted_domain: Cleaned user provided domain
+        :return: True if the domain can be used as is once the server is confirmed to exist
+        """
+        return not wanted_domain.lower().startswith("www.")
+
+    def _get_following_public_redirects(self, url: str, headers: dict) -> requests.Response | None:
+        """
+        GETs the url, following redirects by hand so that every hop is checked with _is_public_hostname
+        before a request is sent to it
+
+        :param url: Url to get
+        :param headers: Headers to send with every request
+        :return: The first response that is not a redirect, or None if a redirect pointed somewhere we will
+        not send requests to or there were too many of them
+        """
+        for _ in range(_MAX_REDIRECTS + 1):
+            response = self._http.get(url, headers=headers, timeout=HTTP_TIMEOUT, allow_redirects=False)
+            if not response.is_redirect:
+                return response
+            url = urljoin(url, response.headers["Location"])
+            parsed_url = urlsplit(url)
+            if parsed_url.scheme != "https" or not self._is_public_hostname(parsed_url.hostname or ""):
+                self.logger.warning("Refusing to follow redirect to %s", url)
+                return None
+        self.logger.warning("Too many redirects when getting %s", url)
+        return None
+
+    def _is_public_hostname(self, wanted_domain: str) -> bool:
+        """
+        Checks that the cleaned domain is a well formed hostname, and that every address it resolves to is public.
+        Loopback, private and other non public addresses are rejected so users cannot make the server
+        send requests to internal hosts. The name is resolved again when the request is sent, so a server
+        changing its DNS answer in between is not caught
+
+        :param wanted_domain: Cleaned user provided domain. Internationalized domains (eg. mastodon.café) are accepted
+        :return: True if the domain is worth sending a request to, False otherwise
+        """
+        try:
+            ascii_domain = wanted_domain.encode("idna").decode("ascii")
+        except UnicodeError:
+            return False  # Eg. a label longer than 63 characters
+        if not _DOMAIN_RE.match(ascii_domain) or ascii_domain.lower().endswith(".localhost"):
+            return False
+        try:
+            address_infos = socket.getaddrinfo(ascii_domain, 443, proto=socket.IPPROTO_TCP)
+        except OSError:
+            return False  # Does not resolve, so it cannot be a mastodon server either
+        try:
+            return bool(address_infos) and all(ipaddress.ip_address(sockaddr[0]).is_global
+                                               for *_, sockaddr in address_infos)
+        except ValueError:
+            return False
+
+    def _get_cached_domain(self, wanted_domain: str) -> str | None:
+        """
+        Looks up a previously verified domain, evicting the entry if it has outlived the cache ttl.
+        Only successful verifications are cached so that transient failures are retried on the next call
+
+        :param wanted_domain: Cleaned user provided domain
+        :return: The canonical domain if it was verified recently, None otherwise
+        """
+        cached = self._domain_cache.get(wanted_domain)
+        if cached is None:
+            return None
+        verified_at, canonical_domain = cached
+        if time.monotonic() - verified_at > self.domain_cache_ttl:
+            self._domain_cache.pop(wanted_domain, None)
+            return None
+        return canonical_domain
+
     def _clean_user_provided_domain(self, user_provided_domain: str) -> str:
         """
         Private function to clean the user provided domain string, to get rid of variance
@@ -89,13 +227,13 @@ class MastodonOAuthInterface:
         :param user_provided_domain: String provided by the user
         :return: Cleaned user domain (as a string)
         """
-        parsed_input = urlparse(user_provided_domain)
+        parsed_input = urlsplit(user_provided_domain.strip())
         if parsed_input.scheme:
             # user provided http in string. This changes the way the standard library parses the url
             wanted_domain = parsed_input.netloc
         else:
-            # user did not provide http in string
-            wanted_domain = parsed_input.path
+            # user did not provide http in string. Drop anything after the host, eg. a trailing slash
+            wanted_domain = parsed_input.path.partition("/")[0]
         return wanted_domain
 
     # ===== Functions that help to generate user access tokens ======
@@ -111,20 +249,39 @@ class MastodonOAuthInterface:
         :return: None, but there is a side effect of setting self.app_client
         """
         try:
+            # A fresh client per flow, as log_in replaces the client's access token with the user's. Only the
+            # http session is shared, so connections to the server are still reused
             client = Mastodon(
                 client_id=client_id,
                 client_secret=client_secret,
                 access_token=access_token,
                 api_base_url=user_domain,
+                session=get_shared_session(user_domain),
+                # The version check fetches the instance info before returning. Skip it here and run it in the
+                # background below instead, so starting the client does not block on the server
+                version_check_mode="none",
             )
             # Be careful: Wrong information used to start this client will not cause
             # the code to fail. Failure will only occur when the client is used later on
             self.app_client = client
         except (ConnectionError, MastodonAPIError) as err:
-            self.logger.error("Encountered {e} when trying to start app_client".format(e=err))
+            self.logger.error("Encountered %s when trying to start app_client", err)
             raise ServiceUnavailableError({"message": "Mastodon API client failed to start",
                                            "redirect_path": REDIRECT_ADD_SERVER})
+        # Run the version check in the background while the user is busy authorizing the app. Every client needs
+        # it, as log_in otherwise runs it synchronously right after the token exchange
+        threading.Thread(target=self._warm, args=(client,), daemon=True).start()
 
+    def _warm(self, client: Mastodon):
+        """
+        Runs the client's version check, which also leaves a live connection in the shared session's pool.
+        Mastodon.py swallows failures and retries the check in log_in, so they are only logged
+
+        :param client: The client to check the server version for
+        """
+        client.retrieve_mastodon_version()
+        if not client.version_check_worked:
+            self.logger.debug("Failed to retrieve the server version of %s", client.api_base_url)
 
     def generate_redirect_url(self, num_tries=3) -> str:
         """
@@ -133,22 +290,23 @@ class MastodonOAuthInterface:
         :param num_tries: Number of tries to generate a redirect url before giving up. Default value of 3
         :return: The redirect url as a string or None (upon connection failure)
         """
-        assert self.app_client is not None, "App client has not been initialized"
-
-        for i in range(num_tries):
-            try:
-                # It redirects the user to copy and paste an authorization code
-                # Note that it does NOT check if the url generated is valid
-                url = self.app_client.auth_request_url(redirect_uris=self.REDIRECT_URI, scopes=self.REQUIRED_SCOPES)
-                return url
-            except MastodonAPIError as err:
-                self.logger.error(
-                    "Encountered MastodonAPIError {e} in generate_redirect url. Retrying." "".format(e=err)
-                )
-
-        # This following code will only run if the above code failed n times.
-        raise ServiceUnavailableError({"message": "Failed to generate url error after trying {n} times. Throwing error"
-                                      .format(n=num_tries), "redirect_path": REDIRECT_ADD_SERVER})
+        if self.app_client is None:
+            raise RuntimeError(_UNSET_CLIENT_MSG)
+
+        try:
+            return self._request_redirect_url(num_tries=num_tries)
+        except (MastodonConnError, MastodonAPIError):
+            # This following code will only run if the above code failed n times, or the server rejected it
+            raise ServiceUnavailableError({"message": "Failed to generate url error after trying {n} times. "
+                                                      "Throwing error".format(n=num_tries),
+                                           "redirect_path": REDIRECT_ADD_SERVER})
+
+    @retry_on(host_of=operator.attrgetter("app_client.api_base_url"))
+    def _request_redirect_url(self) -> str:
+        # It redirects the user to copy and paste an authorization code
+        # Note that it does NOT check if the url generated is valid
+        # Mastodon.py expects a list of scopes
+        return self.app_client.auth_request_url(redirect_uris=self.REDIRECT_URI, scopes=list(self.REQUIRED_SCOPES))
 
     def generate_user_access_token(self, user_auth_code: str, num_tries=3) -> str:
         """
@@ -159,31 +317,55 @@ class MastodonOAuthInterface:
         :param num_tries: Number of times to repeat in case of failure before throwing exception
         :return: The user access token (as a str) that will allow our app to act on the user's behalf
         """
-        assert self.app_client is not None, "App client has not been initialized"
-
-        for i in range(num_tries):
-            try:
-                users_access_token = self.app_client.log_in(
-                    code=user_auth_code,
-                    redirect_uri=self.REDIRECT_URI,
-                    scopes=self.REQUIRED_SCOPES,
-                )
+        if self.app_client is None:
+            raise RuntimeError(_UNSET_CLIENT_MSG)
+
+        # Hash the code so raw secrets are not held as dictionary keys
+        cache_key = (self.app_client.api_base_url, hashlib.sha256(user_auth_code.encode()).digest())
+        cached = self._token_cache.get(cache_key)
+        if cached is not None:
+            generated_at, users_access_token = cached
+            if time.monotonic() - generated_at <= TOKEN_CACHE_TTL:
                 return users_access_token
-            except mastodon.errors.MastodonIllegalArgumentError as e:
-                illegal_arg_error_msg = (
-                    "Encountered error {e} trying to generate user access token. User "
-                    "authorization code provided is likely invalid. Aborting".format(e=e)
-                )
-                self.logger.error(illegal_arg_error_msg)
-                raise InvalidApiInputError(illegal_arg_error_msg)
-            except (ConnectionError, MastodonAPIError) as err:
-                self.logger.error("Encountered {e} when trying to generate_user_access_token." "Retrying".format(e=err))
-
-        error_message = "Failed to generate user access token after trying {n} times. Throwing error".format(
-            n=num_tries
+            del self._token_cache[cache_key]
+
+        try:
+            users_access_token = self._log_in_user(user_auth_code, num_tries=num_tries)
+        except (mastodon.errors.MastodonIllegalArgumentError, mastodon.errors.MastodonUnauthorizedError) as e:
+            illegal_arg_error_msg = (
+                "Encountered error {e} trying to generate user access token. User "
+                "authorization code provided is likely invalid. Aborting".format(e=e)
+            )
+            self.logger.error(illegal_arg_error_msg)
+            raise InvalidApiInputError(illegal_arg_error_msg)
+        except MastodonAPIError as err:
+            error_message = "Server rejected the request for a user access token: {e}".format(e=err)
+            self.logger.error(error_message)
+            raise MastodonConnError(error_message)
+        # Only successful exchanges are cached, so an invalid code is never memoized
+        self._cache_user_access_token(cache_key, users_access_token)
+        return users_access_token
+
+    @retry_on(host_of=operator.attrgetter("app_client.api_base_url"))
+    def _log_in_user(self, user_auth_code: str) -> str:
+        return self.app_client.log_in(
+            code=user_auth_code,
+            redirect_uri=self.REDIRECT_URI,
+            scopes=list(self.REQUIRED_SCOPES),
         )
-        self.logger.error(error_message)
-        raise MastodonConnError(error_message)
+
+    def _cache_user_access_token(self, cache_key: tuple[str, bytes], users_access_token: str):
+        """
+        Stores a freshly generated token. Auth codes are single use and rarely looked up again, so expired
+        entries are swept here rather than waiting for a read that may never come
+
+        :param cache_key: (api base url, hash of auth code) the token was generated for
+        :param users_access_token: The generated user access token
+        """
+        now = time.monotonic()
+        self._token_cache = {key: entry for key, entry in self._token_cache.items()
+                             if now - entry[0] <= TOKEN_CACHE_TTL}
+        self._token_cache[cache_key] = (now, users_access_token)
 
     # ===== Functions that add information about a new client in a new domain into the db =====
 
@@ -207,14 +389,14 @@ class MastodonOAuthInterface:
         :param domain_name: Add domain_name to database, with its client id, client secret and access token
         """
         try:
-            self.logger.info("Adding domain {d} to database".format(d=domain_name))
+            self.logger.info("Adding domain %s to database", domain_name)
             client_id, client_secret = self._create_new_mastodon_client(domain_name)
             access_token = self._request_auth_token_from_mastodon(client_id, client_secret, domain_name)
             app_token = ApplicationTokens(server=domain_name, client_id=client_id, client_secret=client_secret,
                                           access_token=access_token, redirect_uri=self.REDIRECT_URI)
             dbi.session.add(app_token)
             dbi.session.commit()
-            self.logger.info("Completed adding domain {d} to database".format(d=domain_name))
+            self.logger.info("Completed adding domain %s to database", domain_name)
             return client_id, client_secret, access_token
         except sqlalchemy.exc.SQLAlchemyError:
             raise ServiceUnavailableError({
@@ -226,7 +408,7 @@ class MastodonOAuthInterface:
         """Function that registers a new client (bot) with Mastodon
 
         :param domain_name: Domain to create the client for"""
-        self.logger.info("Creating new Mastodon client with domain {d}".format(d=domain_name))
+        self.logger.info("Creating new Mastodon client with domain %s", domain_name)
         api_url = "https://" + domain_name + "/api/v1/apps"
 
         payload = {
@@ -246,9 +428,9 @@ class MastodonOAuthInterface:
             return client_id, client_secret
         except requests.exceptions.RequestException as e:
             # Handle exceptions that might occur during the request
-            self.logger.error("Encountered error {e} trying to create new mastodon client".format(e=e))
+            self.logger.error("Encountered error %s trying to create new mastodon client", e)
             if response is not None:
-                self.logger.error("Response status is: {r}".format(r=response.status_code))
+                self.logger.error("Response status is: %s", response.status_code)
             raise ServiceUnavailableError({
                 "redirect_path": "feed/add_sever.html",
                 "message": SERVICE_UNAVAILABLE_MSG
@@ -273,19 +455,19 @@ class MastodonOAuthInterface:
         }
         response = None
         try:
-            self.logger.info("Requesting auth token from domain {d}".format(d=domain_name))
+            self.logger.info("Requesting auth token from domain %s", domain_name)
             headers = self._generate_headers_for_api_call()
             response = requests.post(token_url, data=payload_token, headers=headers)
             response.raise_for_status()  # Raises an HTTPError if the HTTP request returned an unsuccessful status code
             response_dict_token = json.loads(response.text)
             access_token = response_dict_token['access_token']
-            self.logger.info("Successfully requested auth token from domain {d}".format(d=domain_name))
+            self.logger.info("Successfully requested auth token from domain %s", domain_name)
             return access_token
         except requests.exceptions.RequestException as e:
             # Handle exceptions that might occur during the request
-            self.logger.error("Encountered error {e} trying to obtain auth token from Mastodon".format(e=e))
+            self.logger.error("Encountered error %s trying to obtain auth token from Mastodon", e)
             if response is not None:
-                self.logger.error("Response status is: {r}".format(r=response.status_code))
+                self.logger.error("Response status is: %s", response.status_code)
             raise ServiceUnavailableError({
                 "redirect_path": "feed/add_sever.html",
                 "message": SERVICE_UNAVAILABLE_MSG
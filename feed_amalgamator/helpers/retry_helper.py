@@ -0,0 +1,222 @@
+"""Centralized retry policy for calls to Mastodon servers.
+
+Retries are spaced out with exponential backoff and jitter, so a struggling server gets time to recover
+and users who failed at the same moment do not all retry in lockstep"""
+
+import asyncio
+import functools
+import logging
+import random
+import threading
+import time
+from collections.abc import Awaitable, Callable
+from typing import TypeVar
+
+from mastodon.errors import (
+    MastodonAPIError,
+    MastodonGatewayTimeoutError,
+    MastodonIllegalArgumentError,
+    MastodonNetworkError,
+    MastodonServerError,
+    MastodonServiceUnavailableError,
+    MastodonUnauthorizedError,
+)
+
+from feed_amalgamator.helpers.custom_exceptions import InvalidApiInputError, MastodonConnError
+
+T = TypeVar("T")
+
+RETRY_BASE_DELAY = 0.25  # Seconds to wait after the first failure
+RETRY_MAX_DELAY = 8.0  # Upper bound on the wait between two tries, before jitter
+CIRCUIT_FAILURE_THRESHOLD = 5  # Consecutive failed tries against a server before calls to it are short-circuited
+CIRCUIT_RESET_TIMEOUT = 30.0  # Seconds a tripped circuit stays open before a server is tried again
+
+# Errors that mean the server could not be reached or failed on its side. These are worth another try, and count
+# towards tripping the server's circuit. MastodonNetworkError covers DNS, connection and timeout failures
+RETRIABLE_ERRORS = (ConnectionError, MastodonNetworkError, MastodonServerError, MastodonGatewayTimeoutError,
+                    MastodonServiceUnavailableError)
+# Errors that mean the server answered and rejected our input. Trying again will not change the answer
+NON_RETRIABLE_ERRORS = (InvalidApiInputError, MastodonUnauthorizedError, MastodonIllegalArgumentError)
+# Any other answer from the server, eg. a 404 or 422 for one particular request, is not retried either and shows
+# the server is up, so it must not count against the server for every other user
+_SERVER_ANSWERED_ERRORS = NON_RETRIABLE_ERRORS + (MastodonAPIError,)
+
+
+class CircuitBreaker:
+    """Tracks consecutive failures per server. Once a server has failed too often in a row, calls to it fail
+    immediately for a while instead of each waiting through num_tries timeouts against a dead server"""
+
+    def __init__(self, failure_threshold: int = CIRCUIT_FAILURE_THRESHOLD,
+                 reset_timeout: float = CIRCUIT_RESET_TIMEOUT):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        """host -> (consecutive failures, time of the latest failure)"""
+        self._failures: dict[str, tuple[int, float]] = {}
+        self._lock = threading.Lock()
+
+    def allow(self, host: str) -> bool:
+        """
+        Checks whether calls to the host should go through. After reset_timeout has passed, calls are let
+        through again; a further failure re-opens the circuit straight away
+
+        :param host: Server about to be called
+        :return: False if the circuit for the host is open, True otherwise
+        """
+        with self._lock:
+            num_failures, last_failure = self._failures.get(host, (0, 0.0))
+        return num_failures < self.failure_threshold or time.monotonic() - last_failure >= self.reset_timeout
+
+    def record_success(self, host: str):
+        with self._lock:
+            self._failures.pop(host, None)
+
+    def record_failure(self, host: str):
+        with self._lock:
+            num_failures, _ = self._failures.get(host, (0, 0.0))
+            self._failures[host] = (num_failures + 1, time.monotonic())
+
+
+"""Shared by every retried call, so all users of a dead server benefit from the circuit tripping"""
+circuit_breaker = CircuitBreaker()
+
+
+def compute_backoff_delay(attempt: int, err: Exception | None = None, base: float = RETRY_BASE_DELAY,
+                          cap: float = RETRY_MAX_DELAY) -> float | None:
+    """
+    Computes how long to wait before the next try. A Retry-After header sent by the server takes precedence,
+    unless it asks for a longer wait than cap, in which case the caller should give up rather than block
+
+    :param attempt: Zero based index of the try that just failed
+    :param err: The error the try failed with. Used to look for a Retry-After header
+    :param base: Seconds to wait after the first failure
+    :param cap: Upper bound on the wait, before jitter
+    :return: Seconds to sleep before trying again, or None if there should be no further try
+    """
+    retry_after = _get_retry_after(err)
+    if retry_after is not None:
+        return retry_after if retry_after <= cap else None
+    return min(cap, base * 2**attempt) * random.uniform(0.5, 1.5)
+
+
+def _get_retry_after(err: Exception | None) -> float | None:
+    """
+    Extracts the Retry-After header (in seconds) from errors carrying http headers, either through a response
+    (eg. requests' HTTPError) or directly (eg. aiohttp's ClientResponseError)
+
+    :param err: The error to inspect
+    :return: The number of seconds the server asked us to wait, or None if it did not say
+    """
+    response = getattr(err, "response", None)
+    headers = getattr(response, "headers", None) if response is not None else getattr(err, "headers", None)
+    if not headers:
+        return None
+    retry_after = headers.get("Retry-After")
+    try:
+        return max(0.0, float(retry_after)) if retry_after is not None else None
+    except ValueError:
+        # Retry-After may also be an http date. Fall back to our own backoff rather than parse it
+        return None
+
+
+def retry_on(exc_types: tuple[type[Exception], ...] = RETRIABLE_ERRORS, tries: int = 3, base: float = RETRY_BASE_DELAY,
+             cap: float = RETRY_MAX_DELAY, host_of: Callable[[object], str] | None = None,
+             breaker: CircuitBreaker = circuit_breaker):
+    """
+    Decorator for interface methods that call a Mastodon server. Failed tries raising exc_types are retried with
+    backoff and count as failures of the server, other errors are re-raised immediately, and MastodonConnError
+    is raised once every try has failed. The decorated method accepts an extra num_tries keyword argument
+    overriding tries. The instance the method is bound to must have a logger attribute
+
+    :param exc_types: Errors that are worth another try
+    :param tries: Default maximum number of tries
+    :param base: Seconds to wait after the first failure
+    :param cap: Upper bound on the wait between two tries, before jitter
+    :param host_of: Returns the server the instance is talking to. Enables the circuit breaker if provided
+    :param breaker: Circuit breaker tracking failures per server
+    """
+    def decorator(method: Callable[..., T]) -> Callable[..., T]:
+        @functools.wraps(method)
+        def wrapper(self, *args, num_tries: int = tries, **kwargs) -> T:
+            action_name = method.__name__
+            host = host_of(self) if host_of is not None else None
+            num_tries_made = 0
+            for attempt in range(num_tries):
+                if host is not None and not breaker.allow(host):
+                    error_message = "Too many recent failures from {h}. Skipping {a}".format(h=host, a=action_name)
+                    self.logger.error(error_message)
+                    raise MastodonConnError(error_message)
+                num_tries_made += 1
+                try:
+                    result = method(self, *args, **kwargs)
+                except exc_types as err:
+                    if host is not None:
+                        breaker.record_failure(host)
+                    delay = compute_backoff_delay(attempt, err, base, cap)
+                    if attempt == num_tries - 1 or delay is None:
+                        self.logger.error("Encountered %s in %s", err, action_name)
+                        break
+                    self.logger.error("Encountered %s in %s. Retrying in %.2fs", err, action_name, delay)
+                    time.sleep(delay)
+                except _SERVER_ANSWERED_ERRORS:
+                    if host is not None:
+                        breaker.record_success(host)  # The server is up, it just rejected this request
+                    raise
+                else:
+                    if host is not None:
+                        breaker.record_success(host)
+                    return result
+            # Fewer than num_tries if the server asked us to wait longer than cap
+            error_message = "Failed to {a} after trying {n} times".format(a=action_name.lstrip("_"), n=num_tries_made)
+            self.logger.error(error_message)
+            raise MastodonConnError(error_message)
+        return wrapper
+    return decorator
+
+
+async def async_retry_with_backoff(func: Callable[[], Awaitable[T]], num_tries: int,
+                                   retriable_errors: tuple[type[Exception], ...], logger: logging.Logger,
+                                   action_name: str, host: str | None = None,
+                                   breaker: CircuitBreaker = circuit_breaker) -> T:
+    """
+    Coroutine counterpart of retry_on, sharing its backoff and circuit breaker. Sleeps without blocking the
+    event loop, so other requests being fanned out keep making progress while this one waits
+
+    :param func: Zero argument callable returning a fresh awaitable for every try
+    :param num_tries: Maximum number of times to call func
+    :param retriable_errors: Errors that are worth another try
+    :param logger: Logger of the caller, to log failed tries to
+    :param action_name: Name of the action being tried, used in log messages
+    :param host: Server func talks to. Enables the circuit breaker if provided
+    :param breaker: Circuit breaker tracking failures per server
+    :return: The result of the awaitable returned by func
+    :raises MastodonConnError: Once num_tries tries have failed, or if the circuit for the host is open
+    """
+    num_tries_made = 0
+    for attempt in range(num_tries):
+        if host is not None and not breaker.allow(host):
+            error_message = "Too many recent failures from {h}. Skipping {a}".format(h=host, a=action_name)
+            logger.error(error_message)
+            raise MastodonConnError(error_message)
+        num_tries_made += 1
+        try:
+            result = await func()
+        except retriable_errors as err:
+            if host is not None:
+                breaker.record_failure(host)
+            delay = compute_backoff_delay(attempt, err)
+            if attempt == num_tries - 1 or delay is None:
+                logger.error("Encountered %s in %s", err, action_name)
+                break
+            logger.error("Encountered %s in %s. Retrying in %.2fs", err, action_name, delay)
+            await asyncio.sleep(delay)
+        except Exception:
+            if host is not None:
+                breaker.record_success(host)  # Any other error means the server answered and rejected this request
+            raise
+        else:
+            if host is not None:
+                breaker.record_success(host)
+            return result
+    error_message = "Failed to {a} after trying {n} times".format(a=action_name, n=num_tries_made)
+    logger.error(error_message)
+    raise MastodonConnError(error_message)
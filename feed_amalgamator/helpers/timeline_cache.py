@@ -0,0 +1,90 @@
+"""In memory cache of recently fetched timelines, kept warm by a background refresh in MastodonDataInterface.
+
+Serving repeat polls from here takes the Mastodon API's latency out of the user facing request path,
+at the cost of posts being up to staleness_budget seconds old"""
+
+import hashlib
+import threading
+import time
+
+"""(user domain, user access token, timeline name, number of posts to get), as accepted by fetch_many"""
+TimelineRequest = tuple[str, str, str, int]
+
+
+class TimelineCache:
+    """Thread safe cache of timelines keyed by (domain, hash of access token, timeline name, number of posts).
+    Also remembers which timelines were requested recently, so the background refresh only polls active users"""
+
+    def __init__(self, staleness_budget: float, idle_timeout: float):
+        """
+        :param staleness_budget: Seconds a fetched timeline may be served from the cache
+        :param idle_timeout: Seconds after its last request that a timeline stops being refreshed and is dropped
+        """
+        self.staleness_budget = staleness_budget
+        self.idle_timeout = idle_timeout
+        """key -> (time fetched, posts)"""
+        self._entries: dict[tuple, tuple[float, list[dict]]] = {}
+        """key -> (request, time last requested). The raw request, token included, is needed to refresh it"""
+        self._requests: dict[tuple, tuple[TimelineRequest, float]] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _make_key(request: TimelineRequest) -> tuple:
+        user_domain, user_access_token, timeline_name, num_posts_to_get = request
+        # Hash the token so raw credentials are not held as dictionary keys
+        return user_domain, hashlib.sha256(user_access_token.encode()).hexdigest(), timeline_name, num_posts_to_get
+
+    def get(self, request: TimelineRequest) -> list[dict] | None:
+        """
+        Looks up a timeline and marks it as recently requested, so the background refresh keeps it warm
+
+        :param request: The wanted timeline
+        :return: Copies of the cached posts if they are within the staleness budget, None otherwise. Copies are
+        returned as callers add and remove fields on the posts they receive
+        """
+        key = self._make_key(request)
+        now = time.monotonic()
+        with self._lock:
+            self._requests[key] = (request, now)
+            entry = self._entries.get(key)
+        if entry is None or now - entry[0] > self.staleness_budget:
+            return None
+        return [dict(post) for post in entry[1]]
+
+    def put(self, request: TimelineRequest, posts: list[dict]):
+        """
+        Stores a freshly fetched timeline. A copy of each post is stored, so later changes made by the
+        caller to the posts it got back do not leak into the cache
+
+        :param request: The timeline that was fetched
+        :param posts: The fetched posts
+        """
+        key = self._make_key(request)
+        with self._lock:
+            self._entries[key] = (time.monotonic(), [dict(post) for post in posts])
+
+    def forget(self, request: TimelineRequest):
+        """
+        Drops a timeline and stops refreshing it, eg. once its access token has been revoked
+
+        :param request: The timeline to drop
+        """
+        key = self._make_key(request)
+        with self._lock:
+            self._requests.pop(key, None)
+            self._entries.pop(key, None)
+
+    def active_requests(self) -> list[TimelineRequest]:
+        """
+        Lists the timelines requested within the idle timeout, dropping everything about the others
+
+        :return: The timelines worth refreshing
+        """
+        now = time.monotonic()
+        with self._lock:
+            idle_keys = [key for key, (_, last_requested) in self._requests.items()
+                         if now - last_requested > self.idle_timeout]
+            for key in idle_keys:
+                del self._requests[key]
+                self._entries.pop(key, None)
+            return [request for request, _ in self._requests.values()]
@@ -24,7 +24,7 @@ class TestAuthPage(unittest.TestCase):
         parser.read(test_config_loc)
         test_db_name = parser["TEST_SETTINGS"]["test_db_location"]
 
-        self.app = create_app(db_file_name=test_db_name)
+        self.app = create_app(test_config={"TIMELINE_BACKGROUND_REFRESH": False}, db_file_name=test_db_name)
         with self.app.app_context():
             dbi.drop_all()  # For a clean slate in the test db
             dbi.create_all()
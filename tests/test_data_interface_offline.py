@@ -0,0 +1,113 @@
+import asyncio
+import logging
+import unittest
+from unittest.mock import AsyncMock, MagicMock, patch
+
+import aiohttp
+
+from feed_amalgamator.helpers.custom_exceptions import InvalidCredentialsError, ServiceUnavailableError
+from feed_amalgamator.helpers.mastodon_data_interface import MastodonDataInterface
+
+
+def make_post() -> dict:
+    """A post as decoded from the REST API, reblogging another post"""
+    return {"id": "1", "created_at": "2024-01-02T03:04:05.000+00:00",
+            "reblog": {"id": "2", "created_at": "2024-01-01T00:00:00.000+00:00"}}
+
+
+class FakeResponse:
+    """Stand in for an aiohttp response, used as the async context manager returned by session.get"""
+    def __init__(self, status: int, body=None, headers: dict | None = None):
+        self.status = status
+        self.body = body if body is not None else []
+        self.headers = headers or {}
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+    async def json(self):
+        return self.body
+
+    def raise_for_status(self):
+        if self.status >= 400:
+            raise aiohttp.ClientResponseError(MagicMock(), (), status=self.status, headers=self.headers)
+
+
+class FakeSession:
+    """Stand in for an aiohttp ClientSession answering every get with the next of the given responses"""
+    def __init__(self, *responses: FakeResponse):
+        self.responses = list(responses)
+        self.urls = []
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+    def get(self, url, **kwargs):
+        self.urls.append(url)
+        return self.responses.pop(0)
+
+
+@patch("feed_amalgamator.helpers.retry_helper.asyncio.sleep", new_callable=AsyncMock)
+class TestFetchTimelines(unittest.TestCase):
+    """The aiohttp session is faked, so these run offline. Each test uses its own server so failures recorded
+    by the shared circuit breaker do not leak between tests"""
+
+    def setUp(self):
+        self.data_api = MastodonDataInterface(logging.getLogger("data_interface_offline_test"))
+
+    def _fetch_many(self, session: FakeSession, timelines: list[tuple]):
+        with patch("feed_amalgamator.helpers.mastodon_data_interface.aiohttp.TCPConnector"), \
+                patch("feed_amalgamator.helpers.mastodon_data_interface.aiohttp.ClientSession",
+                      return_value=session):
+            return asyncio.run(self.data_api.fetch_many(timelines))
+
+    def test_stored_servers_with_a_scheme_are_normalized(self, mock_sleep):
+        session = FakeSession(FakeResponse(200))
+        self._fetch_many(session, [("https://scheme.example/", "token", "home", 20)])
+        self.assertEqual(["https://scheme.example/api/v1/timelines/home"], session.urls)
+
+    def test_posts_are_standardized(self, mock_sleep):
+        (timeline,) = self._fetch_many(FakeSession(FakeResponse(200, [make_post()])),
+                                       [("posts.example", "token", "home", 20)])
+        self.assertEqual(2024, timeline[0]["created_at"].year)
+        self.assertEqual(2, timeline[0]["created_at"].day)
+        self.assertEqual(1, timeline[0]["reblog"]["created_at"].day)  # Reblogged posts are standardized too
+
+    def test_unauthorized_raises_invalid_credentials(self, mock_sleep):
+        session = FakeSession(FakeResponse(401))
+        self.assertRaises(InvalidCredentialsError, self._fetch_many, session,
+                          [("unauthorized.example", "token", "home", 20)])
+        self.assertEqual(1, len(session.urls))
+
+    def test_client_errors_are_not_retried(self, mock_sleep):
+        session = FakeSession(FakeResponse(404))
+        self.assertRaises(ServiceUnavailableError, self._fetch_many, session,
+                          [("not-found.example", "token", "home", 20)])
+        self.assertEqual(1, len(session.urls))
+        mock_sleep.assert_not_called()
+
+    def test_rate_limits_and_server_errors_are_retried(self, mock_sleep):
+        session = FakeSession(FakeResponse(429), FakeResponse(503), FakeResponse(200, [{"id": "1"}]))
+        (timeline,) = self._fetch_many(session, [("flaky.example", "token", "home", 20)])
+        self.assertEqual([{"id": "1"}], timeline)
+        self.assertEqual(3, len(session.urls))
+
+    def test_server_errors_raise_service_unavailable_after_last_try(self, mock_sleep):
+        session = FakeSession(*[FakeResponse(503) for _ in range(3)])
+        self.assertRaises(ServiceUnavailableError, self._fetch_many, session, [("down.example", "token", "home", 20)])
+        self.assertEqual(3, len(session.urls))
+
+    def test_fresh_timelines_are_served_from_cache_in_request_order(self, mock_sleep):
+        cached_request = ("cached.example", "token", "home", 20)
+        self.data_api.timeline_cache.put(cached_request, [{"id": "cached"}])
+        session = FakeSession(FakeResponse(200, [{"id": "fetched"}]))
+
+        timelines = self._fetch_many(session, [("fetched.example", "token", "home", 20), cached_request])
+        self.assertEqual([[{"id": "fetched"}], [{"id": "cached"}]], timelines)
+        self.assertEqual(["https://fetched.example/api/v1/timelines/home"], session.urls)
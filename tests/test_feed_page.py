@@ -1,11 +1,13 @@
 import configparser
 import unittest
 from pathlib import Path
+from unittest.mock import AsyncMock, patch
 
 from werkzeug.security import generate_password_hash
 
 from feed_amalgamator import create_app, dbi
-from feed_amalgamator.constants.common_constants import USER_ID_FIELD, USER_DOMAIN_FIELD, SERVERS_FIELD
+from feed_amalgamator.constants.common_constants import USER_ID_FIELD, USER_DOMAIN_FIELD, SERVERS_FIELD, \
+    ORIGINAL_SERVER_FIELD, FILTER_LIST, SORT_BY
 from feed_amalgamator.constants.error_messages import NO_CONTENT_FOUND_MSG, INVALID_MASTODON_DOMAIN_MSG, \
     INVALID_DELETE_SERVER_RECORD_MSG
 from feed_amalgamator.helpers.db_interface import User, ApplicationTokens, UserServer
@@ -20,7 +22,7 @@ class TestFeedPage(unittest.TestCase):
         parser.read(test_config_loc)
         test_db_name = parser["TEST_SETTINGS"]["test_db_location"]
 
-        self.app = create_app(db_file_name=test_db_name)
+        self.app = create_app(test_config={"TIMELINE_BACKGROUND_REFRESH": False}, db_file_name=test_db_name)
         self.app.config.update(
             {
                 "TESTING": True,
@@ -73,6 +75,34 @@ class TestFeedPage(unittest.TestCase):
         self.assertIn(self.client_domain, decoded_resp)
         self.assertIn(self.alt_client_domain, decoded_resp)
 
+    @patch("feed_amalgamator.feed.render_template", return_value="rendered")
+    @patch("feed_amalgamator.feed.data_api.fetch_many", new_callable=AsyncMock)
+    def test_feed_home_merges_timelines_of_all_servers(self, mock_fetch_many, mock_render_template):
+        """Same flow as test_feed_amalgamation, with the Mastodon API mocked out"""
+        with self.app.app_context():
+            user = User(username="Meowmaster", password=generate_password_hash("Infinite4oid!"))
+            dbi.session.add(user)
+            dbi.session.commit()
+            dbi.session.add(UserServer(user_id=1, server="https://one.example", token="tokenOne"))
+            dbi.session.add(UserServer(user_id=1, server="two.example", token="tokenTwo"))
+            dbi.session.commit()
+
+        def make_post(post_id: str, favourites_count: int) -> dict:
+            return dict({field: None for field in FILTER_LIST}, id=post_id, **{SORT_BY: favourites_count})
+        mock_fetch_many.return_value = [[make_post("a", 1)], [make_post("b", 5)]]
+
+        client = self.app.test_client()
+        with client.session_transaction() as sess:
+            sess[USER_ID_FIELD] = 1
+        client.get("{r}/home".format(r=self.page_root))
+
+        wanted_timelines = mock_fetch_many.call_args[0][0]
+        self.assertEqual(["https://one.example", "two.example"], [timeline[0] for timeline in wanted_timelines])
+        timelines = mock_render_template.call_args.kwargs["timelines"]
+        self.assertEqual(["b", "a"], [post["id"] for post in timelines])  # Merged and sorted across servers
+        self.assertEqual("two.example", timelines[0][ORIGINAL_SERVER_FIELD])
+        self.assertNotIn(FILTER_LIST[0], timelines[0])
+
     def test_no_servers_added(self):
         """Proper error message should be found when the user has no servers added but visits the home page"""
         client = self.app.test_client()
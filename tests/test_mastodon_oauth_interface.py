@@ -39,9 +39,14 @@ class TestOauthInterface(unittest.TestCase):
         mangled_domain = "mastodo.social"
         self.assertEqual(self.client.verify_user_provided_domain(mangled_domain)[0], False)
 
+    def test_verify_rejects_malformed_and_internal_domains(self):
+        for bad_domain in ["", "hello world", "localhost", "-mastodon.social", "127.0.0.1", "192.168.1.1",
+                           "https://10.0.0.1", "127.0.0.1.nip.io"]:
+            self.assertEqual(self.client.verify_user_provided_domain(bad_domain)[0], False)
+
     def test_generate_user_token(self):
-        # No client has been started yet, AssertionError should be thrown
-        self.assertRaises(AssertionError, self.client.generate_user_access_token, "undefined")
+        # No client has been started yet, RuntimeError should be thrown
+        self.assertRaises(RuntimeError, self.client.generate_user_access_token, "undefined")
 
         self.client.start_app_api_client(
             self.client_domain, self.client_id, self.client_secret, self.access_token
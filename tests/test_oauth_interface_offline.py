@@ -0,0 +1,183 @@
+import ipaddress
+import logging
+import socket
+import unittest
+from unittest.mock import MagicMock, patch
+
+from mastodon.errors import MastodonIllegalArgumentError
+
+from feed_amalgamator.constants.common_constants import TOKEN_CACHE_TTL
+from feed_amalgamator.helpers.custom_exceptions import InvalidApiInputError
+from feed_amalgamator.helpers.mastodon_oauth_interface import MastodonOAuthInterface
+
+REDIRECT_URI = "urn:ietf:wg:oauth:2.0:oob"
+
+
+def fake_getaddrinfo(*addresses: str):
+    """Builds a stand in for socket.getaddrinfo resolving any name to the given addresses.
+    Like the real one, ip addresses resolve to themselves"""
+    def getaddrinfo(host, port, *args, **kwargs):
+        try:
+            resolved = [str(ipaddress.ip_address(host))]
+        except ValueError:
+            resolved = addresses
+        return [(socket.AF_INET, socket.SOCK_STREAM, socket.IPPROTO_TCP, "", (address, port))
+                for address in resolved]
+    return getaddrinfo
+
+
+def make_response(status_code: int, headers: dict | None = None, content: bytes = b"") -> MagicMock:
+    response = MagicMock(status_code=status_code, headers=headers or {}, content=content)
+    response.is_redirect = "Location" in response.headers
+    return response
+
+
+@patch("feed_amalgamator.helpers.mastodon_oauth_interface.threading.Thread")
+@patch("feed_amalgamator.helpers.mastodon_oauth_interface.Mastodon")
+class TestStartAppApiClient(unittest.TestCase):
+    def setUp(self):
+        self.client = MastodonOAuthInterface(logging.getLogger("oauth_interface_offline_test"), REDIRECT_URI)
+
+    def test_every_client_is_warmed(self, mock_mastodon, mock_thread):
+        self.client.start_app_api_client("warm.example", "id", "secret", "token")
+        self.client.start_app_api_client("warm.example", "id", "secret", "token")
+        self.assertEqual(2, mock_mastodon.call_count)  # A fresh client per flow
+        self.assertEqual(2, mock_thread.call_count)
+
+    def test_warming_runs_the_version_check(self, mock_mastodon, mock_thread):
+        app_client = MagicMock(version_check_worked=True)
+        self.client._warm(app_client)
+        app_client.retrieve_mastodon_version.assert_called_once_with()
+
+
+class TestPublicHostname(unittest.TestCase):
+    """Checks run before any request is sent to a user provided domain. DNS is patched, so these run offline"""
+
+    def setUp(self):
+        self.client = MastodonOAuthInterface(logging.getLogger("oauth_interface_offline_test"), REDIRECT_URI)
+
+    @patch("feed_amalgamator.helpers.mastodon_oauth_interface.socket.getaddrinfo",
+           side_effect=fake_getaddrinfo("127.0.0.1"))
+    def test_rejects_names_resolving_to_internal_addresses(self, mock_getaddrinfo):
+        self.assertFalse(self.client._is_public_hostname("127.0.0.1.nip.io"))
+
+    @patch("feed_amalgamator.helpers.mastodon_oauth_interface.socket.getaddrinfo",
+           side_effect=fake_getaddrinfo("151.101.1.1", "10.0.0.1"))
+    def test_rejects_names_with_any_internal_address(self, mock_getaddrinfo):
+        self.assertFalse(self.client._is_public_hostname("mixed.example"))
+
+    @patch("feed_amalgamator.helpers.mastodon_oauth_interface.socket.getaddrinfo",
+           side_effect=fake_getaddrinfo("151.101.1.1"))
+    def test_accepts_internationalized_domains(self, mock_getaddrinfo):
+        self.assertTrue(self.client._is_public_hostname("mastodon.café"))
+        self.assertEqual("mastodon.xn--caf-dma", mock_getaddrinfo.call_args[0][0])
+
+    @patch("feed_amalgamator.helpers.mastodon_oauth_interface.socket.getaddrinfo",
+           side_effect=socket.gaierror("Name or service not known"))
+    def test_rejects_names_that_do_not_resolve(self, mock_getaddrinfo):
+        self.assertFalse(self.client._is_public_hostname("mastodo.social"))
+
+    @patch("feed_amalgamator.helpers.mastodon_oauth_interface.socket.getaddrinfo",
+           side_effect=fake_getaddrinfo("151.101.1.1"))
+    def test_does_not_follow_redirects_to_internal_hosts(self, mock_getaddrinfo):
+        self.client._http = MagicMock()
+        self.client._http.get.return_value = make_response(301, {"Location": "https://localhost/api/v2/instance"})
+        self.assertFalse(self.client.verify_user_provided_domain("www.mastodon.example")[0])
+        self.assertEqual(1, self.client._http.get.call_count)
+        self.assertFalse(self.client._http.get.call_args.kwargs["allow_redirects"])
+
+    @patch("feed_amalgamator.helpers.mastodon_oauth_interface.socket.getaddrinfo",
+           side_effect=fake_getaddrinfo("151.101.1.1"))
+    def test_rejects_internal_canonical_domains(self, mock_getaddrinfo):
+        self.client._http = MagicMock()
+        self.client._http.get.return_value = make_response(200, {"Content-Type": "application/json"},
+                                                           b'{"domain": "10.0.0.5"}')
+        self.assertFalse(self.client.verify_user_provided_domain("www.evil.example")[0])
+        self.assertIsNone(self.client._get_cached_domain("www.evil.example"))
+
+
+@patch("feed_amalgamator.helpers.mastodon_oauth_interface.socket.getaddrinfo",
+       side_effect=fake_getaddrinfo("151.101.1.1"))
+@patch("feed_amalgamator.helpers.mastodon_oauth_interface.time.monotonic")
+class TestDomainCache(unittest.TestCase):
+    def setUp(self):
+        self.client = MastodonOAuthInterface(logging.getLogger("oauth_interface_offline_test"), REDIRECT_URI,
+                                             domain_cache_ttl=600)
+        self.client._http = MagicMock()
+        self.client._http.head.return_value = make_response(200, {"Content-Type": "application/json"})
+
+    def test_verified_domains_are_cached_until_ttl(self, mock_time, mock_getaddrinfo):
+        mock_time.return_value = 1000
+        self.assertEqual((True, "mastodon.example"), self.client.verify_user_provided_domain("mastodon.example"))
+
+        mock_time.return_value = 1600
+        self.assertEqual((True, "mastodon.example"), self.client.verify_user_provided_domain("mastodon.example"))
+        self.assertEqual(1, self.client._http.head.call_count)
+
+        mock_time.return_value = 1601  # Past the ttl
+        self.assertEqual((True, "mastodon.example"), self.client.verify_user_provided_domain("mastodon.example"))
+        self.assertEqual(2, self.client._http.head.call_count)
+
+    def test_failed_verifications_are_not_cached(self, mock_time, mock_getaddrinfo):
+        mock_time.return_value = 1000
+        self.client._http.head.return_value = make_response(404)
+        self.client._http.get.return_value = make_response(404)
+        self.assertFalse(self.client.verify_user_provided_domain("mastodon.example")[0])
+
+        self.client._http.head.return_value = make_response(200, {"Content-Type": "application/json"})
+        self.assertTrue(self.client.verify_user_provided_domain("mastodon.example")[0])
+        self.assertEqual(2, self.client._http.head.call_count)
+
+
+@patch("feed_amalgamator.helpers.mastodon_oauth_interface.time.monotonic")
+class TestTokenCache(unittest.TestCase):
+    def setUp(self):
+        self.client = MastodonOAuthInterface(logging.getLogger("oauth_interface_offline_test"), REDIRECT_URI)
+        self.client.app_client = MagicMock(api_base_url="https://mastodon.example")
+        self.client.app_client.log_in.return_value = "user token"
+
+    def test_tokens_are_reused_until_ttl(self, mock_time):
+        mock_time.return_value = 1000
+        self.assertEqual("user token", self.client.generate_user_access_token("auth code"))
+
+        mock_time.return_value = 1000 + TOKEN_CACHE_TTL
+        self.assertEqual("user token", self.client.generate_user_access_token("auth code"))
+        self.assertEqual(1, self.client.app_client.log_in.call_count)
+
+        mock_time.return_value = 1001 + TOKEN_CACHE_TTL  # Past the ttl
+        self.assertEqual("user token", self.client.generate_user_access_token("auth code"))
+        self.assertEqual(2, self.client.app_client.log_in.call_count)
+
+    def test_invalid_codes_are_never_cached(self, mock_time):
+        mock_time.return_value = 1000
+        self.client.app_client.log_in.side_effect = MastodonIllegalArgumentError("invalid grant")
+        self.assertRaises(InvalidApiInputError, self.client.generate_user_access_token, "bad code")
+
+        self.client.app_client.log_in.side_effect = None
+        self.assertEqual("user token", self.client.generate_user_access_token("bad code"))
+        self.assertEqual(2, self.client.app_client.log_in.call_count)
+
+
+@patch("feed_amalgamator.helpers.mastodon_oauth_interface.socket.getaddrinfo",
+       side_effect=fake_getaddrinfo("151.101.1.1"))
+class TestInstanceHeadFastPath(unittest.TestCase):
+    def setUp(self):
+        self.client = MastodonOAuthInterface(logging.getLogger("oauth_interface_offline_test"), REDIRECT_URI)
+        self.client._http = MagicMock()
+        self.client._http.get.return_value = make_response(200, {"Content-Type": "application/json"},
+                                                           b'{"domain": "mastodon.example"}')
+
+    def test_json_head_response_skips_get(self, mock_getaddrinfo):
+        self.client._http.head.return_value = make_response(200, {"Content-Type": "application/json; charset=utf-8"})
+        self.assertEqual((True, "mastodon.example"), self.client.verify_user_provided_domain("Mastodon.example"))
+        self.client._http.get.assert_not_called()
+
+    def test_non_json_head_response_falls_back_to_get(self, mock_getaddrinfo):
+        self.client._http.head.return_value = make_response(200, {"Content-Type": "text/html"})
+        self.assertEqual((True, "mastodon.example"), self.client.verify_user_provided_domain("mastodon.example"))
+        self.assertEqual(1, self.client._http.get.call_count)
+
+    def test_www_domains_read_canonical_domain_with_get(self, mock_getaddrinfo):
+        self.assertEqual((True, "mastodon.example"), self.client.verify_user_provided_domain("www.mastodon.example"))
+        self.client._http.head.assert_not_called()
+        self.assertEqual(1, self.client._http.get.call_count)
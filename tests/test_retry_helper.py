@@ -0,0 +1,120 @@
+import asyncio
+import logging
+import unittest
+from unittest.mock import AsyncMock, patch
+
+from mastodon.errors import MastodonNetworkError, MastodonNotFoundError
+
+from feed_amalgamator.helpers.custom_exceptions import InvalidApiInputError, MastodonConnError
+from feed_amalgamator.helpers.retry_helper import CircuitBreaker, retry_on, compute_backoff_delay, \
+    async_retry_with_backoff
+
+
+class FlakyClient:
+    """Stand in for an interface class. Fails a set number of times before succeeding"""
+    def __init__(self, num_failures: int, error: Exception, breaker: CircuitBreaker):
+        self.logger = logging.getLogger("retry_helper_test")
+        self.host = "mastodon.test"
+        self.num_failures = num_failures
+        self.error = error
+        self.num_calls = 0
+        self.breaker = breaker
+
+    def call(self, **kwargs):
+        @retry_on(host_of=lambda client: client.host, breaker=self.breaker)
+        def _call(client):
+            client.num_calls += 1
+            if client.num_calls <= client.num_failures:
+                raise client.error
+            return "ok"
+        return _call(self, **kwargs)
+
+
+@patch("feed_amalgamator.helpers.retry_helper.time.sleep")
+class TestRetryOn(unittest.TestCase):
+    def test_succeeds_after_retriable_failures(self, mock_sleep):
+        client = FlakyClient(2, ConnectionError("boom"), CircuitBreaker())
+        self.assertEqual("ok", client.call())
+        self.assertEqual(3, client.num_calls)
+        self.assertEqual(2, mock_sleep.call_count)
+
+    def test_raises_conn_error_after_last_try(self, mock_sleep):
+        client = FlakyClient(5, ConnectionError("boom"), CircuitBreaker())
+        self.assertRaises(MastodonConnError, client.call, num_tries=2)
+        self.assertEqual(2, client.num_calls)
+        self.assertEqual(1, mock_sleep.call_count)  # No sleep after the final try
+
+    def test_non_retriable_error_is_raised_immediately(self, mock_sleep):
+        client = FlakyClient(5, InvalidApiInputError("bad code"), CircuitBreaker())
+        self.assertRaises(InvalidApiInputError, client.call)
+        self.assertEqual(1, client.num_calls)
+        mock_sleep.assert_not_called()
+
+    def test_network_errors_trip_the_circuit(self, mock_sleep):
+        breaker = CircuitBreaker(failure_threshold=2, reset_timeout=60)
+        client = FlakyClient(5, MastodonNetworkError("dns failure"), breaker)
+        self.assertRaises(MastodonConnError, client.call)
+        self.assertFalse(breaker.allow(client.host))
+
+    def test_request_specific_errors_do_not_count_against_server(self, mock_sleep):
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=60)
+        client = FlakyClient(5, MastodonNotFoundError("not found"), breaker)
+        self.assertRaises(MastodonNotFoundError, client.call)
+        self.assertEqual(1, client.num_calls)
+        self.assertTrue(breaker.allow(client.host))
+
+    def test_open_circuit_skips_calls(self, mock_sleep):
+        breaker = CircuitBreaker(failure_threshold=2, reset_timeout=60)
+        client = FlakyClient(5, ConnectionError("boom"), breaker)
+        self.assertRaises(MastodonConnError, client.call, num_tries=3)
+        self.assertEqual(2, client.num_calls)  # Tripped after the second failure
+
+        self.assertRaises(MastodonConnError, client.call)
+        self.assertEqual(2, client.num_calls)  # Server is not called again while the circuit is open
+
+
+@patch("feed_amalgamator.helpers.retry_helper.asyncio.sleep", new_callable=AsyncMock)
+class TestAsyncRetryWithBackoff(unittest.TestCase):
+    def setUp(self):
+        self.logger = logging.getLogger("retry_helper_test")
+        self.breaker = CircuitBreaker(failure_threshold=2, reset_timeout=60)
+
+    def _run(self, func, num_tries=3):
+        return asyncio.run(async_retry_with_backoff(func, num_tries, (ConnectionError,), self.logger, "fetch",
+                                                    host="mastodon.test", breaker=self.breaker))
+
+    def test_raises_conn_error_after_last_try_and_trips_circuit(self, mock_sleep):
+        func = AsyncMock(side_effect=ConnectionError("boom"))
+        self.assertRaises(MastodonConnError, self._run, func)
+        self.assertEqual(2, func.call_count)  # Tripped after the second failure
+        self.assertFalse(self.breaker.allow("mastodon.test"))
+
+        self.assertRaises(MastodonConnError, self._run, func)
+        self.assertEqual(2, func.call_count)  # Server is not called again while the circuit is open
+
+    def test_non_retriable_error_is_raised_immediately(self, mock_sleep):
+        func = AsyncMock(side_effect=ValueError("rejected"))
+        self.assertRaises(ValueError, self._run, func)
+        self.assertEqual(1, func.call_count)
+        mock_sleep.assert_not_called()
+
+
+class ErrorWithRetryAfter(ConnectionError):
+    def __init__(self, retry_after: str):
+        super().__init__("rate limited")
+        self.headers = {"Retry-After": retry_after}
+
+
+class TestComputeBackoffDelay(unittest.TestCase):
+    def test_honours_short_retry_after(self):
+        self.assertEqual(2.0, compute_backoff_delay(0, ErrorWithRetryAfter("2")))
+
+    def test_gives_up_on_retry_after_longer_than_cap(self):
+        self.assertIsNone(compute_backoff_delay(0, ErrorWithRetryAfter("3600")))
+
+    @patch("feed_amalgamator.helpers.retry_helper.time.sleep")
+    def test_retry_on_stops_when_asked_to_wait_too_long(self, mock_sleep):
+        client = FlakyClient(5, ErrorWithRetryAfter("3600"), CircuitBreaker())
+        self.assertRaisesRegex(MastodonConnError, "after trying 1 times", client.call)
+        self.assertEqual(1, client.num_calls)
+        mock_sleep.assert_not_called()
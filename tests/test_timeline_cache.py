@@ -0,0 +1,43 @@
+import unittest
+from unittest.mock import patch
+
+from feed_amalgamator.helpers.timeline_cache import TimelineCache
+
+
+class TestTimelineCache(unittest.TestCase):
+    def setUp(self) -> None:
+        self.cache = TimelineCache(staleness_budget=60, idle_timeout=600)
+        self.request = ("mastodon.social", "some token", "home", 20)
+
+    @patch("feed_amalgamator.helpers.timeline_cache.time.monotonic")
+    def test_serves_fresh_timelines_only(self, mock_time):
+        mock_time.return_value = 1000
+        self.assertIsNone(self.cache.get(self.request))
+
+        self.cache.put(self.request, [{"id": 1}])
+        self.assertEqual([{"id": 1}], self.cache.get(self.request))
+
+        mock_time.return_value = 1061  # Past the staleness budget
+        self.assertIsNone(self.cache.get(self.request))
+
+    def test_returned_posts_do_not_alias_cache(self):
+        self.cache.put(self.request, [{"id": 1, "uri": "x"}])
+        posts = self.cache.get(self.request)
+        posts[0].pop("uri")  # The feed page removes fields from the posts it gets back
+        self.assertEqual([{"id": 1, "uri": "x"}], self.cache.get(self.request))
+
+    @patch("feed_amalgamator.helpers.timeline_cache.time.monotonic")
+    def test_idle_timelines_are_dropped(self, mock_time):
+        mock_time.return_value = 1000
+        self.cache.get(self.request)
+        self.assertEqual([self.request], self.cache.active_requests())
+
+        mock_time.return_value = 1601
+        self.assertEqual([], self.cache.active_requests())
+
+    def test_forgotten_timelines_are_no_longer_refreshed(self):
+        self.cache.get(self.request)
+        self.cache.put(self.request, [{"id": 1}])
+        self.cache.forget(self.request)
+        self.assertEqual([], self.cache.active_requests())
+        self.assertIsNone(self.cache.get(self.request))